@@ -6,8 +6,11 @@ Created on November 20, 2019
 Driver for FeelTech FY6600 AWG.
 '''
 
+import asyncio
 import serial
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from .base_awg import BaseAWG
 from . import constants
 from .exceptions import UnknownChannelError
@@ -18,14 +21,38 @@ BITS = serial.EIGHTBITS
 PARITY = serial.PARITY_NONE
 STOP_BITS = serial.STOPBITS_ONE
 TIMEOUT = 5
+# Write timeout margin on top of the transmission time of the data
+WRITE_TIMEOUT = 0.05
+# Start, 8 data and stop bit per byte
+BITS_PER_BYTE = 10
 
 # FY6600 Data packet ends with just a single LF (\n) character
-EOL = '\x0A'
-# Channels validation tuple
-CHANNELS = (0, 1, 2)
+EOL_B = b'\x0A'
+# Answers to queries end with CR LF
+EOL_RESP = b'\r\n'
+
+# Pre-encoded command prefixes. WM* commands address channel 1, WF* commands channel 2.
+WMN = b"WMN"
+WFN = b"WFN"
+WMF = b"WMF"
+WFF = b"WFF"
+WFP = b"WFP"
+WMW = b"WMW"
+WFW = b"WFW"
+WMA = b"WMA"
+WFA = b"WFA"
+WMO = b"WMO"
+WFO = b"WFO"
+# Channels validation set
+CHANNELS = frozenset((0, 1, 2))
 CHANNELS_ERROR = "Channel can be 1 or 2."
 # FY6600 requires some delay between commands. 0.5 seconds seems to work, .25 seconds is iffy. Your unit might need more.
+# The delay is only used as a fallback when the unit doesn't acknowledge a command.
 SLEEP_TIME = 0.5
+# How long to wait for the LF acknowledge the FY6600 sends after each command
+ACK_TIMEOUT = 0.05
+# Minimum gap between two consecutive writes
+MIN_GAP = 0.01
 
 # Output impedance of the AWG
 R_IN = 50.0
@@ -47,29 +74,163 @@ class FY6600(BaseAWG):
         self.channel_on = [False, False]
         self.r_load = [50, 50]
         self.v_out_coeff = [1, 1]
+        # Pending payloads while a batch is open, None otherwise
+        self._batch = None
+        # Last pending payload for each command prefix in the open batch
+        self._batch_last = {}
+        self.min_gap = MIN_GAP
+        self._last_write_ts = 0.0
+        # Last command sent for each command prefix, e.g. b"WMF"
+        self._last_sent = {}
+        # Number of commands written whose acknowledge wasn't read yet
+        self._pending_acks = 0
 
     def _connect(self):
-        self.ser = serial.Serial(self.port, BAUD_RATE, BITS, PARITY, STOP_BITS, timeout=self.timeout)
+        # Reads wait for a command acknowledge, get_id raises the timeout for the answer
+        self.ser = serial.Serial(self.port, BAUD_RATE, BITS, PARITY, STOP_BITS, timeout=ACK_TIMEOUT,
+                                 write_timeout=WRITE_TIMEOUT)
 
     def disconnect(self):
         self.printdebug("disconnect")
+        self.await_ready()
+        self.ser.flush()
         self.ser.close()
 
-    def _send_command(self, cmd):
-        cmd = (cmd + EOL).encode()
-        self.ser.write(cmd)
-        time.sleep(SLEEP_TIME)
+    @staticmethod
+    def _check_channel(channel: int):
+        if channel is not None and channel not in CHANNELS:
+            raise UnknownChannelError(CHANNELS_ERROR)
+
+    def _send_bytes(self, payload: bytes):
+        """
+        Sends an already encoded command including the EOL.
+        The command is skipped if the same one was the last sent with its prefix.
+        """
+        prefix = payload[:3]
+        if self._batch is not None:
+            # The batch may already hold a newer value than the one sent
+            if self._batch_last.get(prefix, self._last_sent.get(prefix)) == payload:
+                return
+            self._batch.append(payload)
+            self._batch_last[prefix] = payload
+            return
+        if self._last_sent.get(prefix) == payload:
+            return
+        self._write(payload)
+        # Only remember the command once it was written
+        self._last_sent[prefix] = payload
+        self._wait_ack()
+
+    def _write(self, payload: bytes):
+        # Acknowledges of earlier commands must be read before the next write
+        if self._pending_acks:
+            self.await_ready()
+        # Don't send pulses faster than the device tolerates.
+        # The data is transmitted while the acknowledge is awaited, no flush() is needed here.
+        gap = time.perf_counter() - self._last_write_ts
+        if gap < self.min_gap:
+            time.sleep(self.min_gap - gap)
+        # Drop acknowledges that arrived after their wait timed out
+        self.ser.reset_input_buffer()
+        # Some platforms wait for the transmission to complete, so a long batch needs a longer timeout
+        write_timeout = WRITE_TIMEOUT + len(payload) * BITS_PER_BYTE / BAUD_RATE
+        if write_timeout > self.ser.write_timeout:
+            self.ser.write_timeout = write_timeout
+        try:
+            self.ser.write(payload)
+        except serial.SerialException:
+            # Part of the data may have reached the generator, its state is unknown now
+            self._last_sent = {}
+            self._pending_acks = 0
+            raise
+        self._last_write_ts = time.perf_counter()
+
+    def _wait_ack(self, count: int = 1):
+        """
+        Waits for the acknowledge of count commands.
+        If the unit doesn't reply, sleeps the rest of SLEEP_TIME as before.
+        Late acknowledges are dropped before the next write.
+        """
+        for _ in range(count):
+            ack = self.ser.read_until(EOL_B, size=2)
+            if len(ack) == 0:
+                residual = SLEEP_TIME - (time.perf_counter() - self._last_write_ts)
+                if residual > 0:
+                    time.sleep(residual)
+                return
+
+    def _begin_batch(self):
+        self._batch = []
+        self._batch_last = {}
+
+    def _flush_batch(self, wait: bool = True):
+        batch = self._batch
+        batch_last = self._batch_last
+        self._batch = None
+        self._batch_last = {}
+        if batch:
+            # A single write and a single wait for the whole batch
+            self._write(b"".join(batch))
+            self._last_sent.update(batch_last)
+            self._pending_acks += len(batch)
+            if wait:
+                self.await_ready()
+
+    def await_ready(self):
+        """
+        Waits until the generator has processed the commands sent without waiting.
+        Returns at once if nothing is pending.
+        """
+        count = self._pending_acks
+        self._pending_acks = 0
+        if count:
+            self._wait_ack(count)
+
+    @contextmanager
+    def _batched(self, wait: bool = True):
+        """
+        Collects all commands sent inside the block and writes them at once on exit.
+        If wait is False, the acknowledges are left for await_ready().
+        Nested blocks are merged into the outermost one.
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._begin_batch()
+        try:
+            yield
+        finally:
+            self._flush_batch(wait=wait)
+
+    def pipeline(self):
+        """
+        Groups several setter calls into one serial write followed by one wait.
+
+        Example:
+            with awg.pipeline():
+                awg.set_frequency(0, 1000)
+                awg.set_amplitude(0, 1)
+        """
+        return self._batched()
 
     def initialize(self):
         self.printdebug("initialize")
         self.channel_on = [False, False]
+        # The state of the generator is unknown, everything must be sent again
+        self._last_sent = {}
         self._connect()
-        self.enable_output(None, False)
+        with self._batched():
+            self.enable_output(None, False)
 
     def get_id(self) -> str:
-        self._send_command("UID")
-        ans = self.ser.read_until("\r\n".encode("utf8"), size=None).decode("utf8")
-        return ans.strip()
+        # The answer is read here, so the command is not acknowledged separately.
+        self._write(b"UID" + EOL_B)
+        self.ser.flush()
+        self.ser.timeout = self.timeout
+        try:
+            return self.ser.read_until(EOL_RESP).decode("ascii", "replace").strip()
+        finally:
+            self.ser.timeout = ACK_TIMEOUT
 
     def enable_output(self, channel: int = None, on: bool = False):
         """
@@ -84,23 +245,22 @@ class FY6600(BaseAWG):
 
         Separate commands are thus needed to set the channels for the FY6600.
         """
-        self.printdebug(f"enable_output(channel: {channel}, on:{on})")
-        if channel is not None and channel not in CHANNELS:
-            raise UnknownChannelError(CHANNELS_ERROR)
+        if self.log_debug:
+            self.printdebug(f"enable_output(channel: {channel}, on:{on})")
+        self._check_channel(channel)
 
         if channel is not None and channel != 0:
             self.channel_on[channel - 1] = on
         else:
             self.channel_on = [on, on]
 
-        ch1 = "1" if self.channel_on[0] else "0"
-        ch2 = "1" if self.channel_on[1] else "0"
+        ch1 = b"1" if self.channel_on[0] else b"0"
+        ch2 = b"1" if self.channel_on[1] else b"0"
 
         # The fy6600 uses separate commands to enable each channel.
-        cmd = "WMN%s" % (ch1)
-        self._send_command(cmd)
-        cmd = "WFN%s" % (ch2)
-        self._send_command(cmd)
+        with self._batched():
+            self._send_bytes(WMN + ch1 + EOL_B)
+            self._send_bytes(WFN + ch2 + EOL_B)
 
     def set_frequency(self, channel: int, freq: float):
         """
@@ -113,23 +273,58 @@ class FY6600(BaseAWG):
             WFF00000000000001 equals 1 uHz on channel 2
             and so on.
         """
-        self.printdebug(f"set_frequency(channel: {channel}, freq:{freq})")
-        if channel is not None and channel not in CHANNELS:
-            raise UnknownChannelError(CHANNELS_ERROR)
+        if self.log_debug:
+            self.printdebug(f"set_frequency(channel: {channel}, freq:{freq})")
+        self._check_channel(channel)
 
-        freq_str = "%.2f" % freq
-        freq_str = freq_str.replace(".", "")
-        freq_str = freq_str + "0000"
+        freq_bytes = self._freq_bytes(freq)
 
-        # Channel 1
-        if channel in (0, 1) or channel is None:
-            cmd = "WMF%s" % freq_str
-            self._send_command(cmd)
+        with self._batched():
+            # Channel 1
+            if channel in (0, 1) or channel is None:
+                self._send_bytes(WMF + freq_bytes + EOL_B)
+
+            # Channel 2
+            if channel in (0, 2):
+                self._send_bytes(WFF + freq_bytes + EOL_B)
+
+    def set_frequency_nowait(self, channel: int, freq: float):
+        """
+        Same as set_frequency, but returns right after writing the command.
+        The caller may prepare the next measurement and then call await_ready().
+
+        Example:
+            awg.set_frequency_nowait(1, f)
+            scope.configure(...)
+            awg.await_ready()
+            scope.acquire()
+        """
+        with self._batched(wait=False):
+            self.set_frequency(channel, freq)
 
-        # Channel 2
-        if channel in (0, 2):
-            cmd = "WFF%s" % freq_str
-            self._send_command(cmd)
+    @staticmethod
+    def _freq_bytes(freq: float) -> bytes:
+        # Frequency in uHz with a resolution of 0.01 Hz
+        return b"%014d" % (int(round(freq * 100)) * 10000)
+
+    @classmethod
+    def precompute_freq_commands(cls, freqs, channel: int = 1) -> list:
+        """
+        Builds the frequency commands for a whole sweep in advance.
+        freqs may be any sequence of frequencies in Hz, e.g. a list or a numpy array.
+        The returned commands are sent with send_raw().
+        """
+        if channel not in (1, 2):
+            raise UnknownChannelError(CHANNELS_ERROR)
+        prefix = WMF if channel == 1 else WFF
+        return [prefix + cls._freq_bytes(freq) + EOL_B for freq in freqs]
+
+    def send_raw(self, cmd_bytes: bytes):
+        """
+        Sends a command built in advance, e.g. by precompute_freq_commands().
+        The command must include the EOL.
+        """
+        self._send_bytes(cmd_bytes)
 
     def set_phase(self, channel: int, phase: float):
         """
@@ -140,12 +335,12 @@ class FY6600(BaseAWG):
             WMP100.0 is 100.0 degrees on Channel 1
             WFP4.9 is 4.9 degrees on Channel 2. We are only setting phase on channel 2 here.
         """
-        self.printdebug(f"set_phase(channel: {channel}, phase: {phase}), but forced on channel 2")
+        if self.log_debug:
+            self.printdebug(f"set_phase(channel: {channel}, phase: {phase}), but forced on channel 2")
         if phase < 0:
             phase += 360
 
-        cmd = "WFP%s" % (phase)
-        self._send_command(cmd)
+        self._send_bytes(WFP + b"%.2f" % phase + EOL_B)
 
     def set_wave_type(self, channel: int, wave_type: int):
         """
@@ -156,21 +351,20 @@ class FY6600(BaseAWG):
             WFW00 for Sine wave channel 2
         Both commands are "hard-coded".
         """
-        self.printdebug(f"set_wave_type(channel: {channel}, wavetype:{wave_type}), but forcing sine wave")
-        if channel is not None and channel not in CHANNELS:
-            raise UnknownChannelError(CHANNELS_ERROR)
+        if self.log_debug:
+            self.printdebug(f"set_wave_type(channel: {channel}, wavetype:{wave_type}), but forcing sine wave")
+        self._check_channel(channel)
         if wave_type not in constants.WAVE_TYPES:
             raise ValueError("Incorrect wave type.")
 
-        # Channel 1
-        if channel in (0, 1) or channel is None:
-            cmd = "WMW00"
-            self._send_command(cmd)
+        with self._batched():
+            # Channel 1
+            if channel in (0, 1) or channel is None:
+                self._send_bytes(WMW + b"00" + EOL_B)
 
-        # Channel 2
-        if channel in (0, 2) or channel is None:
-            cmd = "WFW00"
-            self._send_command(cmd)
+            # Channel 2
+            if channel in (0, 2) or channel is None:
+                self._send_bytes(WFW + b"00" + EOL_B)
 
     def set_amplitude(self, channel: int, amplitude: float):
         """
@@ -180,26 +374,24 @@ class FY6600(BaseAWG):
             WMA0.44 for 0.44 volts Channel 1
             WFA9.87 for 9.87 volts Channel 2
         """
-        self.printdebug(f"set_amplitude(channel: {channel}, amplitude:{amplitude})")
-        if channel is not None and channel not in CHANNELS:
-            raise UnknownChannelError(CHANNELS_ERROR)
+        if self.log_debug:
+            self.printdebug(f"set_amplitude(channel: {channel}, amplitude:{amplitude})")
+        self._check_channel(channel)
 
         """
         Adjust the output amplitude to obtain the requested amplitude
         on the defined load impedance.
         """
-        amplitude = amplitude / self.v_out_coeff[channel - 1]
-        amp_str = "%.3f" % amplitude
+        coeff_ch1, coeff_ch2 = self.v_out_coeff
 
-        # Channel 1
-        if channel in (0, 1) or channel is None:
-            cmd = "WMA%s" % amp_str
-            self._send_command(cmd)
+        with self._batched():
+            # Channel 1
+            if channel in (0, 1) or channel is None:
+                self._send_bytes(WMA + b"%.3f" % (amplitude / coeff_ch1) + EOL_B)
 
-        # Channel 2
-        if channel in (0, 2) or channel is None:
-            cmd = "WFA%s" % amp_str
-            self._send_command(cmd)
+            # Channel 2
+            if channel in (0, 2) or channel is None:
+                self._send_bytes(WFA + b"%.3f" % (amplitude / coeff_ch2) + EOL_B)
 
     def set_offset(self, channel: int, offset: float):
         """
@@ -209,31 +401,28 @@ class FY6600(BaseAWG):
         WMO0.33 sets channel 1 offset to 0.33 volts
         WFO-3.33sets channel 2 offset to -3.33 volts
         """
-        self.printdebug(f"set_offset(channel: {channel}, offset:{offset})")
-        if channel is not None and channel not in CHANNELS:
-            raise UnknownChannelError(CHANNELS_ERROR)
-        # Adjust the offset to the defined load impedance
-        offset = offset / self.v_out_coeff[channel - 1]
+        if self.log_debug:
+            self.printdebug(f"set_offset(channel: {channel}, offset:{offset})")
+        self._check_channel(channel)
+        # Adjust the offset to the defined load impedance of each channel
+        coeff_ch1, coeff_ch2 = self.v_out_coeff
 
-        # Channel 1
-        if channel in (0, 1) or channel is None:
-            cmd = "WMO%s" % offset
-            self._send_command(cmd)
+        with self._batched():
+            # Channel 1
+            if channel in (0, 1) or channel is None:
+                self._send_bytes(WMO + b"%.3f" % (offset / coeff_ch1) + EOL_B)
 
-        # Channel 2
-        if channel in (0, 2) or channel is None:
-            cmd = "WFO%s" % offset
-            self._send_command(cmd)
+            # Channel 2
+            if channel in (0, 2) or channel is None:
+                self._send_bytes(WFO + b"%.3f" % (offset / coeff_ch2) + EOL_B)
 
     def set_load_impedance(self, channel: int, z: float):
         """
         Sets load impedance connected to each channel. Default value is 50 Ohm.
         """
-        self.printdebug(f"set_load_impedance(channel: {channel}, impedance:{z})")
-        if channel is not None and channel not in CHANNELS:
-            raise UnknownChannelError(CHANNELS_ERROR)
-
-        self.r_load[channel - 1] = z
+        if self.log_debug:
+            self.printdebug(f"set_load_impedance(channel: {channel}, impedance:{z})")
+        self._check_channel(channel)
 
         """
         Vout coefficient defines how the requestd amplitude must be increased
@@ -247,7 +436,66 @@ class FY6600(BaseAWG):
             v_out_coeff = 1
         else:
             v_out_coeff = z / (z + R_IN)
-        self.v_out_coeff[channel - 1] = v_out_coeff
+
+        # Channel 0 or None sets both channels
+        for ch in ((channel,) if channel in (1, 2) else (1, 2)):
+            self.r_load[ch - 1] = z
+            self.v_out_coeff[ch - 1] = v_out_coeff
+
+
+class AsyncFY6600(object):
+    '''
+    Asyncio front-end for the FY6600 driver.
+
+    Every call is run on a single worker thread, so the commands keep their order
+    and the waits for the generator don't block the event loop.
+    The synchronous FY6600 class remains the interface for existing callers.
+    '''
+
+    def __init__(self, port: str = "", baud_rate: int = BAUD_RATE, timeout: int = TIMEOUT, log_debug: bool = False):
+        self.awg = FY6600(port=port, baud_rate=baud_rate, timeout=timeout, log_debug=log_debug)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def disconnect(self):
+        await self._run(self.awg.disconnect)
+        self._executor.shutdown(wait=False)
+
+    async def initialize(self):
+        await self._run(self.awg.initialize)
+
+    async def get_id(self) -> str:
+        return await self._run(self.awg.get_id)
+
+    async def enable_output(self, channel: int = None, on: bool = False):
+        await self._run(self.awg.enable_output, channel, on)
+
+    async def set_frequency(self, channel: int, freq: float):
+        await self._run(self.awg.set_frequency, channel, freq)
+
+    async def set_frequency_nowait(self, channel: int, freq: float):
+        await self._run(self.awg.set_frequency_nowait, channel, freq)
+
+    async def await_ready(self):
+        await self._run(self.awg.await_ready)
+
+    async def set_phase(self, channel: int, phase: float):
+        await self._run(self.awg.set_phase, channel, phase)
+
+    async def set_wave_type(self, channel: int, wave_type: int):
+        await self._run(self.awg.set_wave_type, channel, wave_type)
+
+    async def set_amplitude(self, channel: int, amplitude: float):
+        await self._run(self.awg.set_amplitude, channel, amplitude)
+
+    async def set_offset(self, channel: int, offset: float):
+        await self._run(self.awg.set_offset, channel, offset)
+
+    async def set_load_impedance(self, channel: int, z: float):
+        await self._run(self.awg.set_load_impedance, channel, z)
 
 
 if __name__ == '__main__':
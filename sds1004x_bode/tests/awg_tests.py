@@ -7,11 +7,16 @@ Created on June 1, 2018
 '''
 
 # stuff needed to get the modules from the parent directory
+import asyncio
 import sys
+import time
 sys.path.insert(0, '..')
 
+import serial
 from awgdrivers.exceptions import UnknownChannelError
 from awgdrivers import constants
+from awgdrivers import fy6600
+from awgdrivers.fy6600 import FY6600, AsyncFY6600
 from awg_factory import awg_factory
 
 # Port settings constants
@@ -37,6 +42,9 @@ config = {"bk4075": {"baud": 19200},
 # if you want to "single step" the tool, ("Press Enter to continue...") , then set this to False
 RUN_UNINTERRUPTED = True
 
+# if you want to test the FY6600 batching/acknowledge logic without a generator, then set this to True
+RUN_FAKE_PORT_TESTS = True
+
 # Here is the section you may want to change -- END
 
 
@@ -127,15 +135,189 @@ def test_awg(awg_name):
         print("Setting output to on on all channels.")
         awg.enable_output(0, True)
 
+        if isinstance(awg, FY6600):
+            test_fy6600_extras(awg)
+
         # Disconnect
         print("Disconnecting from the AWG.")
         awg.disconnect()
+
+        if isinstance(awg, FY6600):
+            test_fy6600_async(port)
     except Exception as e:
         print(f"FAILED. Exception: {e}")
         
 
+def test_fy6600_extras(awg):
+    # FY6600 only: batched, precomputed and non-waiting commands
+    print("Setting CH 1 Frequency: 1000Hz and Amplitude: 1Vpp in one write")
+    with awg.pipeline():
+        awg.set_frequency(1, 1000)
+        awg.set_amplitude(1, 1)
+    get_go_for_next_step()
+    print("Sweeping CH 1 Frequency: 100Hz, 200Hz, 500Hz with precomputed commands")
+    for cmd in FY6600.precompute_freq_commands([100, 200, 500], channel=1):
+        awg.send_raw(cmd)
+    get_go_for_next_step()
+    print("Setting CH 1 Frequency: 2000Hz without waiting")
+    awg.set_frequency_nowait(1, 2000)
+    awg.await_ready()
+    get_go_for_next_step()
+
+
+def test_fy6600_async(port):
+    # FY6600 only: the asyncio front-end
+    async def run():
+        awg = AsyncFY6600(port=port, timeout=TIMEOUT, log_debug=True)
+        await awg.initialize()
+        print(f"AWG id: {await awg.get_id()}")
+        print("Setting CH 1 Frequency: 3000Hz through the asyncio front-end")
+        await awg.set_frequency(1, 3000)
+        await awg.set_frequency_nowait(1, 4000)
+        await awg.await_ready()
+        await awg.disconnect()
+
+    print("Testing the asyncio front-end.")
+    asyncio.run(run())
+
+
+class FakeFY6600Port(object):
+    '''
+    Stands in for serial.Serial. Acknowledges each command after ack_delay seconds.
+    '''
+    instance = None
+
+    def __init__(self, *args, **kwargs):
+        FakeFY6600Port.instance = self
+        self.timeout = kwargs.get("timeout")
+        self.write_timeout = kwargs.get("write_timeout")
+        self.ack_delay = 0.0
+        self.fail_next_write = False
+        self.writes = []
+        # Arrival times of the acknowledges not read yet
+        self.acks = []
+
+    def write(self, data):
+        if self.fail_next_write:
+            self.fail_next_write = False
+            raise serial.SerialTimeoutException("Write timeout")
+        self.writes.append(data)
+        if data != b"UID\n":
+            due = time.perf_counter() + self.ack_delay
+            self.acks.extend([due] * data.count(b"\n"))
+
+    def read_until(self, expected=b"\n", size=None):
+        if expected == b"\r\n":
+            return b"FAKE-FY6600\r\n"
+        deadline = time.perf_counter() + self.timeout
+        if self.acks and self.acks[0] <= deadline:
+            time.sleep(max(0.0, self.acks.pop(0) - time.perf_counter()))
+            return b"\n"
+        time.sleep(self.timeout)
+        return b""
+
+    def reset_input_buffer(self):
+        now = time.perf_counter()
+        self.acks = [due for due in self.acks if due > now]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def test_fy6600_fake_port():
+    # Tests the FY6600 acknowledge, batching and caching logic on a fake port
+    print("\n=====================\nTesting FY6600 on a fake port\n=====================")
+    real_serial, sleep_time = fy6600.serial.Serial, fy6600.SLEEP_TIME
+    fy6600.serial.Serial = FakeFY6600Port
+    fy6600.SLEEP_TIME = 0.2
+    try:
+        awg = FY6600(port="fake", log_debug=True)
+        awg.initialize()
+        port = FakeFY6600Port.instance
+        assert port.writes == [b"WMN0\nWFN0\n"], port.writes
+        assert awg.get_id() == "FAKE-FY6600"
+
+        print("Prompt acknowledges: no fallback delay.")
+        assert timed(awg.set_frequency, 1, 100) < fy6600.SLEEP_TIME / 2
+
+        print("Late acknowledges: every command waits the fallback delay.")
+        port.ack_delay = 0.1
+        for freq in (200, 300, 400):
+            delay = timed(awg.set_frequency, 1, freq)
+            assert delay >= fy6600.SLEEP_TIME * 0.9, f"Stale acknowledge used, waited {delay:.3f} s"
+        port.ack_delay = 0.0
+
+        print("Batch: one write, one acknowledge per command.")
+        del port.writes[:]
+        with awg.pipeline():
+            awg.set_frequency(0, 1000)
+            awg.set_amplitude(0, 1)
+        assert port.writes == [b"WMF00001000000000\nWFF00001000000000\nWMA1.000\nWFA1.000\n"], port.writes
+        assert not port.acks, port.acks
+
+        print("Repeated commands are skipped, a value changed back inside a batch is sent.")
+        del port.writes[:]
+        awg.set_amplitude(0, 1)
+        assert port.writes == [], port.writes
+        with awg.pipeline():
+            awg.set_amplitude(1, 2)
+            awg.set_amplitude(1, 1)
+        assert port.writes == [b"WMA2.000\nWMA1.000\n"], port.writes
+
+        print("A failed write is not cached.")
+        del port.writes[:]
+        port.fail_next_write = True
+        try:
+            awg.set_frequency(1, 100)
+        except serial.SerialTimeoutException:
+            pass
+        awg.set_frequency(1, 100)
+        assert port.writes == [b"WMF00000100000000\n"], port.writes
+
+        print("Precomputed commands and non-waiting frequency changes.")
+        del port.writes[:]
+        for cmd in FY6600.precompute_freq_commands([10, 20], channel=2):
+            awg.send_raw(cmd)
+        awg.set_frequency_nowait(1, 50)
+        assert awg._pending_acks == 1
+        awg.await_ready()
+        assert awg._pending_acks == 0
+        assert port.writes == [b"WFF00000010000000\n", b"WFF00000020000000\n", b"WMF00000050000000\n"], port.writes
+        awg.disconnect()
+
+        print("Asyncio front-end.")
+
+        async def run():
+            async_awg = AsyncFY6600(port="fake")
+            await async_awg.initialize()
+            await async_awg.set_frequency(1, 3000)
+            await async_awg.set_frequency_nowait(1, 4000)
+            await async_awg.await_ready()
+            await async_awg.disconnect()
+
+        asyncio.run(run())
+        assert FakeFY6600Port.instance.writes[-2:] == [b"WMF00003000000000\n", b"WMF00004000000000\n"]
+        print("PASSED.")
+    except Exception as e:
+        print(f"FAILED. Exception: {e!r}")
+    finally:
+        fy6600.serial.Serial, fy6600.SLEEP_TIME = real_serial, sleep_time
+
+
 if __name__ == '__main__':
 
+    if RUN_FAKE_PORT_TESTS:
+        test_fy6600_fake_port()
+
     my_awg = MY_AWG
     
     if my_awg is None: